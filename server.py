@@ -5,211 +5,842 @@ A Flask-based REST API for an anonymous diary with voting, comments,
 file uploads, and admin panel features.
 """
 
-from flask import Flask, request, jsonify, send_from_directory, g
+from flask import Flask, Request, request, jsonify, send_from_directory, g, abort
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 import sqlite3
 import os
 import re
-import datetime
+from werkzeug.exceptions import NotFound
 from werkzeug.utils import secure_filename
+from functools import lru_cache
 import uuid
 import hashlib
 import secrets
-import json
-
-
-BASE_DIR = os.path.dirname(__file__)
+import mimetypes
+import orjson
+import collections
+import contextlib
+import atexit
+import queue
+import threading
+import time
+import io
+import tempfile
+import itertools
+import concurrent.futures
+
+
+# Resolved once so every path below is absolute and free of symlinks, whatever
+# the working directory the server was started from.
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'data.db')
 UPLOADS_DIR = os.path.join(BASE_DIR, 'uploads')
+# Archived entries are written outside the static folder
+ARCHIVE_DIR = os.path.join(os.path.dirname(BASE_DIR), 'archive')
+ARCHIVE_LOG_PATH = os.path.join(os.path.dirname(BASE_DIR), 'archive_logs', 'archive.log')
 ADMIN_PASSKEY = os.environ.get('ADMIN_PASSKEY', 'admin123')
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 RECYCLE_BIN_RETENTION_DAYS = 7
+CLEANUP_INTERVAL_SECONDS = 15 * 60
+# Let the front web server send file bodies: X-Sendfile (Apache/lighttpd) or
+# an nginx `internal` location prefix for X-Accel-Redirect, e.g. /_uploads/
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+X_ACCEL_UPLOADS_PREFIX = os.environ.get('X_ACCEL_UPLOADS_PREFIX', '')
+# Pooled SQLite connections per worker: two per CPU, at most 8 by default
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0)) or min((os.cpu_count() or 1) * 2, 8)
+# Seconds a request waits for a free pooled connection before answering 503
+DB_POOL_TIMEOUT = 10
 
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
 
 ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp'}
 ALLOWED_VIDEO_EXTENSIONS = {'mp4', 'webm'}
+_ALLOWED_EXTENSIONS = {
+    'image': frozenset(ALLOWED_IMAGE_EXTENSIONS),
+    'video': frozenset(ALLOWED_VIDEO_EXTENSIONS),
+}
 MAX_IMAGE_SIZE = 10 * 1024 * 1024  # 10MB
 MAX_VIDEO_SIZE = 100 * 1024 * 1024  # 100MB
+UPLOAD_COPY_BUFFER = 1024 * 1024  # 1MB
+# Bodies above this spool file parts to disk instead of memory
+UPLOAD_SPOOL_THRESHOLD = 500 * 1024  # 500KB
+# Upload names are never reused, so browsers may cache them for good
+UPLOAD_MAX_AGE = 365 * 24 * 3600  # 1 year
+# Largest valid submission: 3 images + 1 video, plus room for the form fields.
+# MAX_REQUEST_SIZE (bytes) in the environment lowers or raises the cap.
+MAX_REQUEST_SIZE = int(os.environ.get('MAX_REQUEST_SIZE', 0)) or (
+    3 * MAX_IMAGE_SIZE + MAX_VIDEO_SIZE + 1024 * 1024)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, used by jsonify() and request.get_json()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default), mimetype=self.mimetype
+        )
+
+
+class UploadRequest(Request):
+    """Request that spools large file parts straight into UPLOADS_DIR.
+
+    save_uploaded_file() can then hard-link the spooled file into place
+    instead of copying it. The temporary name is removed when the request
+    closes its files.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if total_content_length is None or total_content_length > UPLOAD_SPOOL_THRESHOLD:
+            return tempfile.NamedTemporaryFile(dir=UPLOADS_DIR, prefix='.upload-')
+        return io.BytesIO()
+
+
+class EntriesCompressCache:
+    """Flask-Compress cache backend for the compressed /api/entries bodies.
+
+    Flask-Compress asks it for every response it compresses. Only listing
+    responses get a cache key from entries_compress_key(); for any other
+    request get() misses and set() is a no-op. Entries are dropped together
+    with the listing cache.
+    """
+
+    def get(self, key):
+        return _compressed_entries.get(key)
+
+    def set(self, key, value):
+        if key.partition(';')[2].startswith('entries:'):
+            with _entries_cache_lock:
+                if len(_compressed_entries) >= 2 * ENTRIES_CACHE_MAXSIZE:
+                    _compressed_entries.clear()
+                _compressed_entries[key] = value
+
+
+def entries_compress_key(request):
+    """Flask-Compress cache key: the listing body this request served."""
+    return g.get('_entries_body_key')
+
+
+# Site files are served by the routes below rather than Flask's static route
+app = Flask(__name__, static_folder=None)
+app.request_class = UploadRequest
+app.json = OrjsonProvider(app)
+# Werkzeug rejects larger bodies from Content-Length before reading them
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_CACHE_BACKEND'] = EntriesCompressCache
+app.config['COMPRESS_CACHE_KEY'] = entries_compress_key
+Compress(app)
+
+# Frequently executed statements. Keeping them as module constants means the
+# exact same string reaches sqlite3's per-connection statement cache each time.
+SQL_CLEANUP_DELETED = 'DELETE FROM entries WHERE deleted=1 AND deleted_at < ?'
+SQL_INSERT_ENTRY = '''
+    INSERT INTO entries
+    (unique_id, content, tags, images, video, ts, browser_info, is_pinned)
+    VALUES (?,?,?,?,?,?,?,?)
+'''
+SQL_LIST_ENTRIES = '''
+    SELECT e.id, e.unique_id, e.content, e.tags, e.images, e.video, e.ts,
+           e.is_pinned, e.view_count, e.manipulated,
+           e.upvotes, e.downvotes, e.reports_count as reports
+    FROM entries e
+    WHERE e.archived=0 AND e.deleted=0
+    ORDER BY e.is_pinned DESC, e.id DESC
+    LIMIT ?
+'''
+# Admin entry lists (live or recycle bin): votes and reports are aggregated
+# once per table and joined, instead of re-counted for every row.
+SQL_ADMIN_ENTRIES = '''
+    WITH v AS (
+        SELECT entry_id,
+               SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) as up,
+               SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) as down
+        FROM votes GROUP BY entry_id
+    ), r AS (
+        SELECT entry_id, COUNT(*) as cnt FROM reports GROUP BY entry_id
+    )
+    SELECT e.id, e.content,
+           e.is_pinned, e.view_count, e.manipulated,
+           IFNULL(v.up,0) as upvotes,
+           IFNULL(v.down,0) as downvotes,
+           IFNULL(r.cnt,0) as reports
+    FROM entries e
+    LEFT JOIN v ON v.entry_id=e.id
+    LEFT JOIN r ON r.entry_id=e.id
+    WHERE e.deleted=?
+    ORDER BY e.id DESC
+'''
+# Admin dashboard counters, one scan per table
+SQL_ADMIN_ENTRY_STATS = '''
+    SELECT IFNULL(SUM(deleted=0 AND archived=0),0) as entries,
+           IFNULL(SUM(deleted=0 AND archived=1),0) as archived,
+           IFNULL(SUM(deleted=1),0) as deleted
+    FROM entries
+'''
+SQL_ADMIN_COMMENT_STATS = '''
+    SELECT IFNULL(SUM(deleted=0),0) as comments,
+           IFNULL(SUM(deleted=1),0) as deleted
+    FROM comments
+'''
+SQL_ADMIN_COMMENTS = '''
+    SELECT id, entry_id, content, upvotes, downvotes, reports_count as reports
+    FROM comments
+    WHERE deleted=0
+    ORDER BY id DESC
+'''
+# Entries and comments reported more than their threshold, for review
+SQL_ADMIN_ENTRY_REPORTS = '''
+    SELECT 'entry' as type, r.entry_id as target_id,
+           e.upvotes as upvotes,
+           COUNT(*) as report_count,
+           MAX(r.reason) as reason
+    FROM reports r
+    LEFT JOIN entries e ON e.id=r.entry_id
+    GROUP BY r.entry_id
+    HAVING report_count > 2
+'''
+SQL_ADMIN_COMMENT_REPORTS = '''
+    SELECT 'comment' as type, r.comment_id as target_id,
+           IFNULL(c.upvotes,0) as upvotes,
+           COUNT(*) as report_count,
+           MAX(r.reason) as reason
+    FROM comment_reports r
+    LEFT JOIN comments c ON c.id=r.comment_id
+    GROUP BY r.comment_id
+    HAVING report_count > 1
+'''
+# Admin sessions, shared by all worker processes
+SQL_INSERT_ADMIN_TOKEN = 'INSERT INTO admin_tokens (token_hash, expires) VALUES (?,?)'
+# Past ADMIN_TOKEN_MAX sessions, the oldest logins give way
+SQL_CAP_ADMIN_TOKENS = '''
+    DELETE FROM admin_tokens WHERE token_hash NOT IN (
+        SELECT token_hash FROM admin_tokens ORDER BY expires DESC LIMIT ?)
+'''
+SQL_ADMIN_TOKEN_VALID = 'SELECT 1 FROM admin_tokens WHERE token_hash=? AND expires > ?'
+SQL_SWEEP_ADMIN_TOKENS = 'DELETE FROM admin_tokens WHERE expires <= ?'
+# Cast or change a vote in one statement; rowcount is 0 when the identifier
+# already cast this same vote.
+SQL_UPSERT_VOTE = '''
+    INSERT INTO votes (entry_id, identifier, identifier_type, vote, ts) VALUES (?,?,?,?,?)
+    ON CONFLICT(entry_id, identifier, identifier_type)
+    DO UPDATE SET vote=excluded.vote, ts=excluded.ts WHERE vote != excluded.vote
+'''
+SQL_ENTRY_VOTES = 'SELECT upvotes, downvotes FROM entries WHERE id=?'
+# Entry state plus the caller's current vote, so repeat votes need no write
+SQL_ENTRY_FOR_VOTE = '''
+    SELECT e.archived, v.vote AS cur_vote FROM entries e
+    LEFT JOIN votes v ON v.entry_id=e.id AND v.identifier=? AND v.identifier_type=?
+    WHERE e.id=?
+'''
+SQL_ENTRY_FOR_REPORT = 'SELECT id, content, tags, ts, archived FROM entries WHERE id=?'
+SQL_ENTRY_FOR_COMMENT = 'SELECT id, archived, deleted FROM entries WHERE id=?'
+SQL_ENTRY_EXISTS = 'SELECT id FROM entries WHERE id=?'
+SQL_ENTRY_VIEWABLE = 'SELECT id FROM entries WHERE id=? AND deleted=0'
+SQL_LIST_COMMENTS = '''
+    SELECT c.id, c.content, c.ts, c.upvotes, c.downvotes
+    FROM comments c
+    WHERE c.entry_id=?
+    ORDER BY c.id DESC
+    LIMIT 100
+'''
+SQL_INSERT_COMMENT = 'INSERT INTO comments (entry_id, content, identifier, identifier_type, ts) VALUES (?,?,?,?,?)'
+SQL_COMMENT_EXISTS = 'SELECT id FROM comments WHERE id=?'
+SQL_COMMENT_FOR_REPORT = 'SELECT id, entry_id FROM comments WHERE id=?'
+SQL_COMMENT_VOTES = 'SELECT upvotes, downvotes FROM comments WHERE id=?'
+SQL_UPSERT_COMMENT_VOTE = '''
+    INSERT INTO comment_votes (comment_id, identifier, identifier_type, vote, ts) VALUES (?,?,?,?,?)
+    ON CONFLICT(comment_id, identifier, identifier_type)
+    DO UPDATE SET vote=excluded.vote, ts=excluded.ts WHERE vote != excluded.vote
+'''
+# Count a new comment report; over_threshold once more than 10% of its
+# upvotes reported it (RETURNING sees the values after the update).
+SQL_COUNT_COMMENT_REPORT = '''
+    UPDATE comments SET reports_count=reports_count+1 WHERE id=?
+    RETURNING reports_count, upvotes > 0 AND reports_count*10 > upvotes AS over_threshold
+'''
+SQL_DELETE_COMMENT = 'DELETE FROM comments WHERE id=?'
+# Reports are unique per identifier and target; the cursor's rowcount is 0
+# when this identifier already reported it.
+SQL_INSERT_REPORT = '''
+    INSERT OR IGNORE INTO reports (entry_id, identifier, identifier_type, reason, ts)
+    VALUES (?,?,?,?,?)
+'''
+SQL_INSERT_COMMENT_REPORT = '''
+    INSERT OR IGNORE INTO comment_reports (comment_id, identifier, identifier_type, reason, ts)
+    VALUES (?,?,?,?,?)
+'''
+# Upvotes from real votes only: the counter of a manipulated entry includes
+# admin adjustments, so those few entries are counted from votes instead.
+_REAL_UPVOTES = '''CASE WHEN manipulated
+    THEN (SELECT COUNT(*) FROM votes v WHERE v.entry_id=entries.id AND v.vote=1)
+    ELSE upvotes END'''
+# Count a new report and archive the entry once more than 25% of its real
+# upvotes reported it (SET expressions see the values from before the update).
+SQL_REPORT_ENTRY = f'''
+    UPDATE entries SET
+        reports_count = reports_count + 1,
+        archived = CASE WHEN {_REAL_UPVOTES} > 0 AND (reports_count + 1) * 4 > {_REAL_UPVOTES}
+                        THEN 1 ELSE archived END
+    WHERE id=?
+    RETURNING {_REAL_UPVOTES} as upvotes, reports_count, archived
+'''
+
+# How long a connection waits on another writer's lock. Startup waits much
+# longer: a worker may be queued behind another one migrating the schema.
+DB_BUSY_TIMEOUT_MS = 5000
+INIT_BUSY_TIMEOUT_MS = 10 * 60 * 1000
 
-app = Flask(__name__, static_folder=BASE_DIR, static_url_path='')
 
 # Database helpers
+def _connect():
+    """Open a long-lived connection for the pool, with PRAGMAs applied once."""
+    # Autocommit: single statements commit on their own; multi-statement
+    # writes go through write_transaction()
+    db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                         cached_statements=256)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA temp_store=MEMORY')
+    db.execute('PRAGMA mmap_size=268435456')
+    # Page cache of up to 64 MB per connection
+    db.execute('PRAGMA cache_size=-65536')
+    # Wait for a competing writer instead of failing with "database is locked"
+    db.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+    # Enforce the ON DELETE CASCADE references between tables
+    db.execute('PRAGMA foreign_keys=ON')
+    return db
+
+
+# Pool of open connections shared by all requests; a request borrows one
+# in get_db() and hands it back in close_connection().
+_READ_POOL = queue.Queue(maxsize=DB_POOL_SIZE)
+for _ in range(DB_POOL_SIZE):
+    _READ_POOL.put(_connect())
+
+
+@atexit.register
+def _optimize_on_exit():
+    """Let SQLite refresh planner statistics for the queries it has seen."""
+    try:
+        db = _READ_POOL.get_nowait()
+    except queue.Empty:
+        return
+    try:
+        db.execute('PRAGMA optimize')
+    except sqlite3.Error:
+        pass
+
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _READ_POOL.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            # Every connection is busy: shed the request rather than block
+            # until the worker timeout kills the process
+            abort(503)
+        g._database = db
     return db
 
-def init_db():
-    """Initialize database schema with all required tables and columns."""
-    db = get_db()
-    
-    # Create entries table with all columns
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS entries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            unique_id TEXT UNIQUE NOT NULL,
-            content TEXT NOT NULL,
-            tags TEXT,
-            images TEXT,
-            video TEXT,
-            upvotes INTEGER DEFAULT 0,
-            downvotes INTEGER DEFAULT 0,
-            ts TEXT NOT NULL,
-            archived INTEGER DEFAULT 0,
-            deleted INTEGER DEFAULT 0,
-            deleted_at TEXT,
-            is_pinned INTEGER DEFAULT 0,
-            view_count INTEGER DEFAULT 0,
-            manipulated INTEGER DEFAULT 0,
-            manipulated_at TEXT,
-            browser_info TEXT
-        )
-    ''')
-    
-    # Ensure columns exist for older databases
+
+def execute_tuples(db, sql, params=()):
+    """Like db.execute(), but rows are plain tuples instead of sqlite3.Row.
+
+    Meant for hot paths that read many rows and unpack them by position.
+    """
+    cur = db.cursor()
+    cur.row_factory = None
+    return cur.execute(sql, params)
+
+
+def fetch_dicts(db, sql, params=()):
+    """Run a query and return its rows as dicts keyed by column name.
+
+    Column names are read from cursor.description once and zipped with
+    plain tuple rows, instead of converting each sqlite3.Row.
+    """
+    cur = execute_tuples(db, sql, params)
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, row)) for row in cur]
+
+
+@contextlib.contextmanager
+def write_transaction(db):
+    """Run the block in a BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front, so read-then-write sequences (vote
+    checks, counter updates) cannot interleave with another writer.
+    Commits on exit, rolls back if the block raises.
+    """
+    db.execute('BEGIN IMMEDIATE')
     try:
-        cols = [r[1] for r in db.execute("PRAGMA table_info('entries')").fetchall()]
-        if 'archived' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN archived INTEGER DEFAULT 0')
-        if 'images' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN images TEXT')
-        if 'video' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN video TEXT')
-        if 'upvotes' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN upvotes INTEGER DEFAULT 0')
-        if 'downvotes' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN downvotes INTEGER DEFAULT 0')
-        if 'deleted' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN deleted INTEGER DEFAULT 0')
-        if 'unique_id' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN unique_id TEXT')
-        if 'deleted_at' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN deleted_at TEXT')
-        if 'is_pinned' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN is_pinned INTEGER DEFAULT 0')
-        if 'view_count' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN view_count INTEGER DEFAULT 0')
-        if 'manipulated' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN manipulated INTEGER DEFAULT 0')
-        if 'manipulated_at' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN manipulated_at TEXT')
-        if 'browser_info' not in cols:
-            db.execute('ALTER TABLE entries ADD COLUMN browser_info TEXT')
-    except Exception as e:
-        print(f"Migration error: {e}")
-    db.commit()
-    # votes table
+        yield db
+    except Exception:
+        db.execute('ROLLBACK')
+        raise
+    db.execute('COMMIT')
+
+
+# Bump whenever _migrate_schema() learns about a new column or step so
+# existing databases get upgraded on the next start.
+SCHEMA_VERSION = 5
+
+_INITIALIZED = False
+_INIT_LOCK = threading.Lock()
+
+
+def init_db():
+    """Initialize database schema with all required tables and columns.
+
+    Called once at import, before the app serves requests; later calls
+    return immediately. Every worker process runs this, so the whole setup,
+    from reading user_version to bumping it, is one BEGIN IMMEDIATE
+    transaction: workers queue on the write lock and only the first one
+    finds an old version to migrate.
+    """
+    global _INITIALIZED
+    if _INITIALIZED:
+        return
+    with _INIT_LOCK:
+        if _INITIALIZED:
+            return
+        db = get_db()
+        # foreign_keys can only be switched outside a transaction; it must be
+        # off while _rebuild_with_cascades() drops and renames tables
+        db.execute('PRAGMA foreign_keys=OFF')
+        db.execute(f'PRAGMA busy_timeout={INIT_BUSY_TIMEOUT_MS}')
+        try:
+            with write_transaction(db):
+                _create_schema(db)
+                version = db.execute('PRAGMA user_version').fetchone()[0]
+                if version < SCHEMA_VERSION:
+                    _migrate_schema(db, version)
+                    db.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+                _create_indexes(db)
+                _create_triggers(db)
+        finally:
+            db.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+            db.execute('PRAGMA foreign_keys=ON')
+        _INITIALIZED = True
+
+
+# Column definitions of every table. Child rows reference their entry or
+# comment with ON DELETE CASCADE, so deleting the parent cleans them up.
+SCHEMA_TABLES = {
+    'entries': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        unique_id TEXT UNIQUE NOT NULL,
+        content TEXT NOT NULL,
+        tags TEXT,
+        images TEXT,
+        video TEXT,
+        upvotes INTEGER DEFAULT 0,
+        downvotes INTEGER DEFAULT 0,
+        reports_count INTEGER DEFAULT 0,
+        ts TEXT NOT NULL,
+        archived INTEGER DEFAULT 0,
+        deleted INTEGER DEFAULT 0,
+        deleted_at TEXT,
+        is_pinned INTEGER DEFAULT 0,
+        view_count INTEGER DEFAULT 0,
+        manipulated INTEGER DEFAULT 0,
+        manipulated_at TEXT,
+        browser_info TEXT
+    ''',
+    'votes': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_id INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE,
+        identifier TEXT NOT NULL,
+        identifier_type TEXT NOT NULL,
+        vote INTEGER NOT NULL,
+        ts TEXT NOT NULL
+    ''',
+    'reports': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_id INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE,
+        identifier TEXT NOT NULL,
+        identifier_type TEXT NOT NULL,
+        reason TEXT,
+        ts TEXT NOT NULL
+    ''',
+    'comments': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        entry_id INTEGER NOT NULL REFERENCES entries(id) ON DELETE CASCADE,
+        content TEXT NOT NULL,
+        identifier TEXT NOT NULL,
+        identifier_type TEXT NOT NULL,
+        upvotes INTEGER DEFAULT 0,
+        downvotes INTEGER DEFAULT 0,
+        reports_count INTEGER DEFAULT 0,
+        deleted INTEGER DEFAULT 0,
+        ts TEXT NOT NULL
+    ''',
+    'comment_votes': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        comment_id INTEGER NOT NULL REFERENCES comments(id) ON DELETE CASCADE,
+        identifier TEXT NOT NULL,
+        identifier_type TEXT NOT NULL,
+        vote INTEGER NOT NULL,
+        ts TEXT NOT NULL
+    ''',
+    'comment_reports': '''
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        comment_id INTEGER NOT NULL REFERENCES comments(id) ON DELETE CASCADE,
+        identifier TEXT NOT NULL,
+        identifier_type TEXT NOT NULL,
+        reason TEXT,
+        ts TEXT NOT NULL
+    ''',
+    # Last run (epoch seconds) of periodic tasks shared by all workers
+    'maintenance': '''
+        task TEXT PRIMARY KEY,
+        last_run REAL NOT NULL DEFAULT 0
+    ''',
+    # Admin sessions shared by all workers: SHA-256 of the bearer token and
+    # its expiry (epoch seconds)
+    'admin_tokens': '''
+        token_hash TEXT PRIMARY KEY,
+        expires REAL NOT NULL
+    ''',
+}
+
+# Child tables and the (column, parent table) their rows belong to
+CASCADE_TABLES = {
+    'votes': ('entry_id', 'entries'),
+    'reports': ('entry_id', 'entries'),
+    'comments': ('entry_id', 'entries'),
+    'comment_votes': ('comment_id', 'comments'),
+    'comment_reports': ('comment_id', 'comments'),
+}
+
+
+def _create_schema(db):
+    """Create any missing tables."""
+    for table, columns in SCHEMA_TABLES.items():
+        db.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+
+
+# Columns added to each table after it was first created, with their
+# declarations. Keep in sync with SCHEMA_TABLES above.
+MIGRATED_COLUMNS = {
+    'entries': {
+        'archived': 'INTEGER DEFAULT 0',
+        'images': 'TEXT',
+        'video': 'TEXT',
+        'upvotes': 'INTEGER DEFAULT 0',
+        'downvotes': 'INTEGER DEFAULT 0',
+        'deleted': 'INTEGER DEFAULT 0',
+        'unique_id': 'TEXT',
+        'deleted_at': 'TEXT',
+        'is_pinned': 'INTEGER DEFAULT 0',
+        'view_count': 'INTEGER DEFAULT 0',
+        'manipulated': 'INTEGER DEFAULT 0',
+        'manipulated_at': 'TEXT',
+        'browser_info': 'TEXT',
+        'reports_count': 'INTEGER DEFAULT 0',
+    },
+    'comments': {
+        'upvotes': 'INTEGER DEFAULT 0',
+        'downvotes': 'INTEGER DEFAULT 0',
+        'deleted': 'INTEGER DEFAULT 0',
+        'reports_count': 'INTEGER DEFAULT 0',
+    },
+}
+
+
+def _migrate_schema(db, version):
+    """Bring a database at schema `version` up to SCHEMA_VERSION.
+
+    Runs inside init_db()'s transaction: missing columns are added first,
+    versioned steps follow. Statements go through execute() one at a time,
+    as executescript() would commit the enclosing transaction.
+    """
+    for table, expected in MIGRATED_COLUMNS.items():
+        existing = {r[1] for r in db.execute(f"PRAGMA table_info('{table}')")}
+        for col, decl in expected.items():
+            if col not in existing:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {col} {decl}')
+
+    if version < 2:
+        # Superseded by idx_comments_entry_id
+        db.execute('DROP INDEX IF EXISTS idx_comments_entry')
+
+    if version < 3:
+        # Backfill the vote/report counters from the rows they summarize
+        _recount_counters(db)
+
+    if version < 4:
+        # Drop duplicate votes (keeping the latest) and reports (keeping the
+        # first) so the unique indexes can be built, then recount. Manipulated
+        # entries keep their admin-adjusted vote counters.
+        for statement in (
+            '''DELETE FROM votes WHERE id NOT IN (
+                SELECT MAX(id) FROM votes GROUP BY entry_id, identifier, identifier_type)''',
+            '''DELETE FROM comment_votes WHERE id NOT IN (
+                SELECT MAX(id) FROM comment_votes GROUP BY comment_id, identifier, identifier_type)''',
+            '''DELETE FROM reports WHERE id NOT IN (
+                SELECT MIN(id) FROM reports GROUP BY entry_id, identifier, identifier_type)''',
+            '''DELETE FROM comment_reports WHERE id NOT IN (
+                SELECT MIN(id) FROM comment_reports GROUP BY comment_id, identifier, identifier_type)''',
+            'DROP INDEX IF EXISTS idx_votes_entry_ident',
+            'DROP INDEX IF EXISTS idx_comment_votes',
+            'DROP INDEX IF EXISTS idx_reports_entry',
+            'DROP INDEX IF EXISTS idx_comment_reports',
+        ):
+            db.execute(statement)
+        _recount_counters(db, offset_manipulated=False)
+
+    if version < 5:
+        _rebuild_with_cascades(db)
+
+
+def _recount_counters(db, offset_manipulated=True):
+    """Recompute the vote and report counters of entries and comments.
+
+    Each child table is aggregated once with GROUP BY and applied with
+    UPDATE ... FROM, so the cost grows with the number of rows rather than
+    entries x votes (the tally indexes do not exist yet during migration).
+    Manipulated entries keep their admin-adjusted vote counters: with
+    `offset_manipulated` the real votes are added on top of them (before v3
+    adjustments were stored on top of zero), otherwise they are left as is.
+    """
+    skip_manipulated = '' if offset_manipulated else 'AND NOT IFNULL(entries.manipulated, 0)'
     db.execute('''
-        CREATE TABLE IF NOT EXISTS votes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entry_id INTEGER NOT NULL,
-            identifier TEXT NOT NULL,
-            identifier_type TEXT NOT NULL,
-            vote INTEGER NOT NULL,
-            ts TEXT NOT NULL
-        )
+        UPDATE entries SET
+            upvotes = CASE WHEN manipulated THEN IFNULL(upvotes,0) ELSE 0 END,
+            downvotes = CASE WHEN manipulated THEN IFNULL(downvotes,0) ELSE 0 END,
+            reports_count = 0
     ''')
-    # reports table
-    db.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entry_id INTEGER NOT NULL,
-            identifier TEXT NOT NULL,
-            identifier_type TEXT NOT NULL,
-            reason TEXT,
-            ts TEXT NOT NULL
-        )
+    db.execute(f'''
+        UPDATE entries SET upvotes = upvotes + t.up, downvotes = downvotes + t.down
+        FROM (SELECT entry_id, SUM(vote=1) AS up, SUM(vote=-1) AS down
+              FROM votes GROUP BY entry_id) t
+        WHERE t.entry_id = entries.id {skip_manipulated}
     ''')
-    # comments table
     db.execute('''
-        CREATE TABLE IF NOT EXISTS comments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            entry_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            identifier TEXT NOT NULL,
-            identifier_type TEXT NOT NULL,
-            upvotes INTEGER DEFAULT 0,
-            downvotes INTEGER DEFAULT 0,
-            deleted INTEGER DEFAULT 0,
-            ts TEXT NOT NULL
-        )
+        UPDATE entries SET reports_count = t.cnt
+        FROM (SELECT entry_id, COUNT(*) AS cnt FROM reports GROUP BY entry_id) t
+        WHERE t.entry_id = entries.id
     ''')
-    # Ensure upvotes, downvotes, deleted columns exist for older DBs
-    try:
-        cols = [r[1] for r in db.execute("PRAGMA table_info('comments')").fetchall()]
-        if 'upvotes' not in cols:
-            db.execute('ALTER TABLE comments ADD COLUMN upvotes INTEGER DEFAULT 0')
-        if 'downvotes' not in cols:
-            db.execute('ALTER TABLE comments ADD COLUMN downvotes INTEGER DEFAULT 0')
-        if 'deleted' not in cols:
-            db.execute('ALTER TABLE comments ADD COLUMN deleted INTEGER DEFAULT 0')
-    except:
-        pass
-    
-    db.commit()
-    
-    # Create comment votes table
+    db.execute('UPDATE comments SET upvotes = 0, downvotes = 0, reports_count = 0')
     db.execute('''
-        CREATE TABLE IF NOT EXISTS comment_votes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            comment_id INTEGER NOT NULL,
-            identifier TEXT NOT NULL,
-            identifier_type TEXT NOT NULL,
-            vote INTEGER NOT NULL,
-            ts TEXT NOT NULL
-        )
+        UPDATE comments SET upvotes = t.up, downvotes = t.down
+        FROM (SELECT comment_id, SUM(vote=1) AS up, SUM(vote=-1) AS down
+              FROM comment_votes GROUP BY comment_id) t
+        WHERE t.comment_id = comments.id
     ''')
-    # Create comment reports table
     db.execute('''
-        CREATE TABLE IF NOT EXISTS comment_reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            comment_id INTEGER NOT NULL,
-            identifier TEXT NOT NULL,
-            identifier_type TEXT NOT NULL,
-            reason TEXT,
-            ts TEXT NOT NULL
-        )
+        UPDATE comments SET reports_count = t.cnt
+        FROM (SELECT comment_id, COUNT(*) AS cnt FROM comment_reports GROUP BY comment_id) t
+        WHERE t.comment_id = comments.id
     ''')
-    db.commit()
+
+
+def _rebuild_with_cascades(db):
+    """Recreate the child tables with their ON DELETE CASCADE references.
+
+    SQLite cannot add a foreign key to an existing table, so each one is
+    copied into a fresh table (dropping rows whose parent is already gone)
+    and renamed over the old one. Indexes are recreated by _create_indexes().
+    Needs foreign_keys off, which init_db() does before its transaction.
+    """
+    for table, (column, parent) in CASCADE_TABLES.items():
+        cols = ', '.join(r[1] for r in db.execute(f"PRAGMA table_info('{table}')"))
+        db.execute(f'CREATE TABLE {table}_new ({SCHEMA_TABLES[table]})')
+        db.execute(f'INSERT INTO {table}_new ({cols}) SELECT {cols} FROM {table} '
+                   f'WHERE {column} IN (SELECT id FROM {parent})')
+        db.execute(f'DROP TABLE {table}')
+        db.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+
+
+def _create_indexes(db):
+    """Create indexes for the hot lookups (needs the migrated columns)."""
+    # Recycle bin sweep: WHERE deleted=1 AND deleted_at < ?
+    db.execute('CREATE INDEX IF NOT EXISTS idx_entries_deleted_at ON entries(deleted, deleted_at)')
+    # Public listing: WHERE archived=0 AND deleted=0 ORDER BY is_pinned DESC, id DESC
+    db.execute('CREATE INDEX IF NOT EXISTS idx_entries_listing ON entries(deleted, archived, is_pinned DESC, id DESC)')
+    # Vote tallies (covering)
+    db.execute('CREATE INDEX IF NOT EXISTS idx_votes_entry_vote ON votes(entry_id, vote)')
+    # Comments of an entry, newest first
+    db.execute('CREATE INDEX IF NOT EXISTS idx_comments_entry_id ON comments(entry_id, id DESC)')
+    # Comment vote tallies (covering)
+    db.execute('CREATE INDEX IF NOT EXISTS idx_cvotes_comment_vote ON comment_votes(comment_id, vote)')
+    # One vote and one report per identifier and target; these also serve
+    # the per-user lookups and the report counts
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_votes ON votes(entry_id, identifier, identifier_type)')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_comment_votes ON comment_votes(comment_id, identifier, identifier_type)')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_reports ON reports(entry_id, identifier, identifier_type)')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS uq_comment_reports ON comment_reports(comment_id, identifier, identifier_type)')
+
+
+def _create_triggers(db):
+    """Keep the upvotes/downvotes counters in step with the vote tables.
+
+    Reads never aggregate votes; every insert, change or removal of a vote
+    adjusts its entry's or comment's counters. Counters are clamped at 0
+    because admin adjustments share them.
+    """
+    for table, column, parent in (('votes', 'entry_id', 'entries'),
+                                  ('comment_votes', 'comment_id', 'comments')):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE {parent} SET upvotes = upvotes + (NEW.vote = 1),
+                                    downvotes = downvotes + (NEW.vote = -1)
+                WHERE id = NEW.{column};
+            END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_update AFTER UPDATE OF vote ON {table}
+            WHEN OLD.vote != NEW.vote
+            BEGIN
+                UPDATE {parent} SET upvotes = MAX(upvotes + (NEW.vote = 1) - (OLD.vote = 1), 0),
+                                    downvotes = MAX(downvotes + (NEW.vote = -1) - (OLD.vote = -1), 0)
+                WHERE id = NEW.{column};
+            END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_delete AFTER DELETE ON {table}
+            BEGIN
+                UPDATE {parent} SET upvotes = MAX(upvotes - (OLD.vote = 1), 0),
+                                    downvotes = MAX(downvotes - (OLD.vote = -1), 0)
+                WHERE id = OLD.{column};
+            END
+        ''')
+
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        if db.in_transaction:
+            db.rollback()
+        _READ_POOL.put(db)
 
 # Simple sanitization
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-# Regex patterns for sanitization
-SCRIPT_RE = re.compile(r'<script[\s\S]*?>[\s\S]*?<\/script>', re.IGNORECASE)
-ONHANDLER_RE = re.compile(r'on\w+=\"?[^\"\s>]+\"?', re.IGNORECASE)
+# Regex for sanitization: <script> blocks and inline on*= event handlers,
+# matched as one alternation so the text is scanned in a single pass. The
+# opening tag stops at the first '>' so unclosed tags cannot backtrack.
+SANITIZE_RE = re.compile(
+    r'<script[^>]*>[\s\S]*?</script>'
+    r'|\bon\w+=(?:"[^"]*"|\'[^\']*\'|[^\s>]+)',
+    re.IGNORECASE
+)
 
 
 def sanitize(text):
     """Remove potentially dangerous scripts and event handlers from text."""
     if not text:
         return ''
-    text = SCRIPT_RE.sub('', text)
-    text = ONHANDLER_RE.sub('', text)
-    return text.strip()
+    return _sanitize_cached(text)
+
+
+@lru_cache(maxsize=4096)
+def _sanitize_cached(text):
+    return SANITIZE_RE.sub('', text).strip()
 
 
 def allowed_file(filename, file_type):
     """Check if file extension is allowed for given file type."""
-    if '.' not in filename:
+    _, sep, ext = filename.rpartition('.')
+    return bool(sep) and ext.lower() in _ALLOWED_EXTENSIONS.get(file_type, ())
+
+def _stream_fileno(stream):
+    """Return the OS file descriptor backing an upload stream, or None.
+
+    Small uploads are kept in memory and larger ones spooled to a file (see
+    UploadRequest); only the latter can be linked or copied with sendfile().
+    """
+    # SpooledTemporaryFile.fileno() would force an in-memory upload to disk,
+    # so look at the object it wraps instead.
+    inner = getattr(stream, '_file', stream)
+    try:
+        return inner.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _sendfile_all(src_fd, dst_fd, size):
+    """Copy `size` bytes between file descriptors inside the kernel."""
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _copy_limited(src, dst, limit):
+    """Copy src to dst, giving up once more than `limit` bytes were read.
+
+    Returns False if the limit was exceeded.
+    """
+    copied = 0
+    while True:
+        chunk = src.read(UPLOAD_COPY_BUFFER)
+        if not chunk:
+            return True
+        copied += len(chunk)
+        if copied > limit:
+            return False
+        dst.write(chunk)
+
+
+# Mode open() gives new files (0666 minus the umask). Spooled uploads are
+# created 0600, so they are switched to this before being linked into place;
+# a front web server running as another user must be able to read them.
+_umask = os.umask(0o022)
+os.umask(_umask)
+UPLOAD_FILE_MODE = 0o666 & ~_umask
+
+
+def _link_spooled(stream, dst):
+    """Hard-link an upload spooled by UploadRequest to `dst`.
+
+    Returns False if the stream is not such a file or the filesystem
+    refuses the link, in which case the caller copies instead.
+    """
+    path = getattr(stream, 'name', None)
+    if not isinstance(path, str) or os.path.dirname(path) != UPLOADS_DIR:
+        return False
+    try:
+        os.fchmod(stream.fileno(), UPLOAD_FILE_MODE)
+        os.link(path, dst)
+    except OSError:
         return False
-    ext = filename.rsplit('.', 1)[1].lower()
-    if file_type == 'image':
-        return ext in ALLOWED_IMAGE_EXTENSIONS
-    elif file_type == 'video':
-        return ext in ALLOWED_VIDEO_EXTENSIONS
-    return False
+    return True
+
+
+def upload_relpath(filename):
+    """Path of an upload relative to UPLOADS_DIR.
+
+    Uploads are sharded into two levels of subdirectories taken from the
+    first four hex digits of the name (ab/cd/abcd....png) so no directory
+    grows too large. Names from before sharding (dashed UUIDs) live directly
+    in UPLOADS_DIR.
+    """
+    stem = filename.partition('.')[0]
+    if len(stem) == 32:
+        return f"{stem[:2]}/{stem[2:4]}/{filename}"
+    return filename
+
 
 def save_uploaded_file(file, file_type):
     """Save an uploaded file and return the filename, or None if invalid"""
@@ -219,83 +850,323 @@ def save_uploaded_file(file, file_type):
     if not allowed_file(file.filename, file_type):
         return None
     
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    size = file.tell()
-    file.seek(0)
-    
-    if file_type == 'image' and size > MAX_IMAGE_SIZE:
-        return None
-    if file_type == 'video' and size > MAX_VIDEO_SIZE:
-        return None
+    # Check file size; spooled-to-disk uploads report it without seeking
+    max_size = MAX_IMAGE_SIZE if file_type == 'image' else MAX_VIDEO_SIZE
+    src = file.stream
+    src_fd = _stream_fileno(src)
+    if src_fd is not None:
+        size = os.fstat(src_fd).st_size
+        if size > max_size:
+            return None
     
     # Generate unique filename
-    ext = file.filename.rsplit('.', 1)[1].lower()
-    filename = f"{uuid.uuid4()}.{ext}"
-    filepath = os.path.join(UPLOADS_DIR, filename)
+    ext = file.filename.rpartition('.')[2].lower()
+    filename = f"{uuid.uuid4().hex}.{ext}"
+    filepath = os.path.join(UPLOADS_DIR, upload_relpath(filename))
     
     try:
-        file.save(filepath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        if src_fd is not None and _link_spooled(src, filepath):
+            return filename
+        with open(filepath, 'wb') as dst:
+            if src_fd is not None and hasattr(os, 'sendfile'):
+                _sendfile_all(src_fd, dst.fileno(), size)
+            elif not _copy_limited(src, dst, max_size):
+                raise ValueError('upload exceeds size limit')
         return filename
     except Exception:
+        if os.path.exists(filepath):
+            os.remove(filepath)
         return None
 
 
+def _format_utc(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+_ts_cache = (0, '')
+
+
+def iso_now():
+    """Current UTC time as an ISO 8601 string, e.g. '2025-01-31T12:00:00Z'.
+
+    The string is formatted at most once per second and reused in between.
+    """
+    global _ts_cache
+    now = int(time.time())
+    cached = _ts_cache
+    if cached[0] != now:
+        cached = _ts_cache = (now, _format_utc(now))
+    return cached[1]
+
+
 def get_identifier():
-    """Get unique identifier for user (cookie-based or IP-based)."""
+    """Get unique identifier for user (cookie-based or IP-based).
+
+    Computed once per request and cached on `g`.
+    """
+    identifier = getattr(g, '_identifier', None)
+    if identifier is not None:
+        return identifier
+
     cookie_id = request.cookies.get('user_id')
     if cookie_id:
-        return ('cookie', cookie_id)
-    
-    # Get IP address, preferring X-Forwarded-For header (for proxies)
-    xf = request.headers.get('X-Forwarded-For', '')
-    if xf:
-        ip = xf.split(',')[0].strip()
+        identifier = ('cookie', cookie_id)
     else:
-        ip = request.remote_addr or '0.0.0.0'
-    return ('ip', ip)
+        # Get IP address, preferring X-Forwarded-For header (for proxies)
+        xf = request.headers.get('X-Forwarded-For', '')
+        if xf:
+            ip = xf.partition(',')[0].strip()
+        else:
+            ip = request.remote_addr or '0.0.0.0'
+        identifier = ('ip', ip)
+    g._identifier = identifier
+    return identifier
 
 
 def get_browser_info():
-    """Collect browser/device information from request headers."""
-    browser_info = {
-        'user_agent': request.headers.get('User-Agent', 'Unknown'),
-        'ip': request.remote_addr or '0.0.0.0',
-        'timestamp': datetime.datetime.now(datetime.UTC).isoformat()
-    }
-    return json.dumps(browser_info)
+    """Collect browser/device information from request headers.
+
+    Computed once per request and cached on `g`.
+    """
+    browser_info = getattr(g, '_browser_info', None)
+    if browser_info is None:
+        browser_info = g._browser_info = orjson.dumps({
+            'user_agent': request.headers.get('User-Agent', 'Unknown'),
+            'ip': request.remote_addr or '0.0.0.0',
+            'timestamp': iso_now()
+        }).decode()
+    return browser_info
+
+
+# Rendered /api/entries bodies by limit, as (expires_at, json_bytes, key).
+# Local writes that change the listing call invalidate_entries_cache(); the
+# TTL bounds how stale a page can be after writes from other worker processes.
+# `key` is unique per rendered body and names its compressed variants in
+# _compressed_entries, filled by Flask-Compress through EntriesCompressCache.
+ENTRIES_CACHE_TTL = 2.0
+ENTRIES_CACHE_MAXSIZE = 128
+_entries_cache = {}
+_compressed_entries = {}
+_entries_version = 0
+_entries_renders = itertools.count()
+_entries_cache_lock = threading.Lock()
+
+
+def invalidate_entries_cache():
+    """Drop cached listings after a write that changes what they show."""
+    global _entries_version
+    with _entries_cache_lock:
+        _entries_version += 1
+        _entries_cache.clear()
+        _compressed_entries.clear()
 
 
 def cleanup_deleted_entries():
     """Remove entries from recycle bin older than retention period."""
     db = get_db()
-    cutoff_date = (datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=RECYCLE_BIN_RETENTION_DAYS)).isoformat()
-    db.execute(
-        'DELETE FROM entries WHERE deleted=1 AND deleted_at < ?',
-        (cutoff_date,)
-    )
-    db.commit()
+    cutoff_date = _format_utc(time.time() - RECYCLE_BIN_RETENTION_DAYS * 86400)
+    db.execute(SQL_CLEANUP_DELETED, (cutoff_date,))
+
+
+def claim_periodic_task(task, interval):
+    """Return True if this process should run `task` now.
+
+    Every worker runs the same background loops against one database; the
+    first one to move the task's last_run forward wins and the others skip
+    it. A run is due once half the interval has passed, so worker clocks
+    drifting apart cannot push the task past a full interval.
+    """
+    db = get_db()
+    now = time.time()
+    with write_transaction(db):
+        db.execute('INSERT OR IGNORE INTO maintenance (task) VALUES (?)', (task,))
+        cur = db.execute(
+            'UPDATE maintenance SET last_run=? WHERE task=? AND last_run <= ?',
+            (now, task, now - interval / 2)
+        )
+    return cur.rowcount == 1
+
+
+def _cleanup_loop():
+    """Run periodic housekeeping every CLEANUP_INTERVAL_SECONDS.
+
+    Empties expired recycle-bin entries and drops expired admin tokens.
+    """
+    while True:
+        try:
+            with app.app_context():
+                if claim_periodic_task('recycle_bin', CLEANUP_INTERVAL_SECONDS):
+                    cleanup_deleted_entries()
+                    sweep_admin_tokens()
+        except Exception as e:
+            print(f"Recycle bin cleanup error: {e}")
+        time.sleep(CLEANUP_INTERVAL_SECONDS)
+
+
+# Page views are counted in memory and written in one transaction every
+# VIEW_FLUSH_INTERVAL seconds instead of one UPDATE per view.
+VIEW_FLUSH_INTERVAL = 2
+_view_buffer = collections.Counter()
+_view_lock = threading.Lock()
+# Entries known to exist and not be deleted, so repeat views skip the lookup.
+# Other workers delete entries too, so it is emptied on every flush and is
+# stale for at most VIEW_FLUSH_INTERVAL.
+_viewable_entries = set()
+
+
+def flush_view_counts():
+    """Write buffered view counts to the database.
+
+    Views of entries deleted in the meantime are dropped.
+    """
+    _viewable_entries.clear()
+    with _view_lock:
+        if not _view_buffer:
+            return
+        pending = list(_view_buffer.items())
+        _view_buffer.clear()
+    try:
+        db = get_db()
+        with write_transaction(db):
+            db.executemany(
+                'UPDATE entries SET view_count = IFNULL(view_count,0) + ? WHERE id=? AND deleted=0',
+                [(count, entry_id) for entry_id, count in pending]
+            )
+    except Exception:
+        # Keep the views for the next flush
+        with _view_lock:
+            _view_buffer.update(dict(pending))
+        raise
+    invalidate_entries_cache()
+
+
+def _view_flush_loop():
+    """Flush buffered view counts every VIEW_FLUSH_INTERVAL seconds."""
+    while True:
+        time.sleep(VIEW_FLUSH_INTERVAL)
+        try:
+            with app.app_context():
+                flush_view_counts()
+        except Exception as e:
+            print(f"View count flush error: {e}")
+
+
+@atexit.register
+def _flush_views_on_exit():
+    with app.app_context():
+        flush_view_counts()
+
+
+# Archive files are written off the request path, one at a time
+_io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive-io')
+_archive_log = None
+
+
+def write_archive(entry_obj):
+    """Write an archived entry to ARCHIVE_DIR and log it.
+
+    Runs on _io_executor; errors are printed, never raised to the request.
+    """
+    global _archive_log
+    try:
+        # Directories are created and the log opened once, on first use;
+        # only this executor's single thread writes here
+        if _archive_log is None:
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            os.makedirs(os.path.dirname(ARCHIVE_LOG_PATH), exist_ok=True)
+            _archive_log = open(ARCHIVE_LOG_PATH, 'ab', buffering=0)
+        archive_path = os.path.join(ARCHIVE_DIR, f"entry-{entry_obj['id']}.json")
+        with open(archive_path, 'wb') as f:
+            f.write(orjson.dumps(entry_obj, option=orjson.OPT_INDENT_2))
+        _archive_log.write(
+            f"{entry_obj['archived_at']} ARCHIVE entry {entry_obj['id']} "
+            f"reports={entry_obj['reports']} upvotes={entry_obj['upvotes']}\n".encode('utf-8')
+        )
+    except Exception as e:
+        print(f"Archive write error: {e}")
+
+
+def start_background_tasks():
+    threading.Thread(target=_cleanup_loop, name='recycle-bin-cleanup', daemon=True).start()
+    threading.Thread(target=_view_flush_loop, name='view-count-flush', daemon=True).start()
+
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({'message':'Archivo demasiado grande'}), 413
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    return jsonify({'message':'Servidor ocupado, inténtalo de nuevo'}), 503, {'Retry-After': '1'}
 
 # ============================================================================
 # STATIC FILE ROUTES
 # ============================================================================
 
+# Site files keep their names across deploys, so they are revalidated with
+# ETag/Last-Modified (304) on every load instead of being cached blindly.
+# They are read into memory once at startup; restart after changing them.
+SITE_FILES = ('index.html', 'admin.html', 'style.css', 'admins.css', 'script.js', 'techo.jpg')
+
+
+def _load_site_files():
+    """Read SITE_FILES as {name: (body, etag, mtime, mimetype)}."""
+    site_files = {}
+    for name in SITE_FILES:
+        path = os.path.join(BASE_DIR, name)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+        except OSError:
+            continue
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        site_files[name] = (body, hashlib.sha1(body).hexdigest(), mtime, mimetype)
+    return site_files
+
+
+_site_files = _load_site_files()
+
+
+def send_site_file(filename):
+    """Serve a site file from memory, answering revalidations with 304.
+
+    Only SITE_FILES are served: BASE_DIR also holds the code, the database
+    and its WAL.
+    """
+    cached = _site_files.get(filename)
+    if cached is None:
+        return jsonify({'message':'File not found'}), 404
+    body, etag, mtime, mimetype = cached
+    response = app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = mtime
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return send_site_file('index.html')
 
 @app.route('/<path:filename>')
 def static_files(filename):
-    return send_from_directory(app.static_folder, filename)
+    return send_site_file(filename)
 
 # Route to serve uploaded files
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
     """Serve uploaded files securely"""
     filename = secure_filename(filename)
-    if not os.path.exists(os.path.join(UPLOADS_DIR, filename)):
+    if X_ACCEL_UPLOADS_PREFIX:
+        # nginx streams the file itself from an `internal` location
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['X-Accel-Redirect'] = X_ACCEL_UPLOADS_PREFIX + upload_relpath(filename)
+        return response
+    try:
+        return send_from_directory(UPLOADS_DIR, upload_relpath(filename),
+                                   conditional=True, max_age=UPLOAD_MAX_AGE)
+    except NotFound:
         return jsonify({'message':'File not found'}), 404
-    return send_from_directory(UPLOADS_DIR, filename)
 
 # ============================================================================
 # ENTRY API ROUTES
@@ -303,8 +1174,10 @@ def serve_upload(filename):
 
 @app.route('/api/submit', methods=['POST'])
 def api_submit():
-    init_db()
-    
+    # Refuse oversized bodies from Content-Length before any multipart parsing
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'message':'Archivo demasiado grande'}), 413
+
     # Get content and tags from form data
     content = request.form.get('content', '').strip()
     tags = request.form.get('tags', '').strip()
@@ -331,7 +1204,7 @@ def api_submit():
     if video_file and video_file.filename:
         video = save_uploaded_file(video_file, 'video')
     
-    ts = datetime.datetime.now(datetime.UTC).isoformat() + 'Z'
+    ts = iso_now()
     db = get_db()
     
     # Generate unique identifier and collect browser info
@@ -342,65 +1215,45 @@ def api_submit():
     images_str = ','.join(images) if images else None
     
     cur = db.execute(
-        '''INSERT INTO entries 
-           (unique_id, content, tags, images, video, ts, browser_info, is_pinned) 
-           VALUES (?,?,?,?,?,?,?,?)''',
+        SQL_INSERT_ENTRY,
         (unique_entry_id, content, tags, images_str, video, ts, browser_info, 0)
     )
-    db.commit()
+    invalidate_entries_cache()
     entry_id = cur.lastrowid
     return jsonify({'message':'ok', 'id': entry_id, 'unique_id': unique_entry_id}), 201
 
 @app.route('/api/entries', methods=['GET'])
 def api_entries():
     """Get list of entries, ordered by pinned status and creation date."""
-    init_db()
-    cleanup_deleted_entries()  # Clean up old deleted entries
-    
-    limit = min(100, int(request.args.get('limit', '20') or '20'))
+    # Untrusted input: anything but a short plain number gets the default,
+    # so garbage or negative limits never reach int() or the query
+    raw_limit = request.args.get('limit', '')
+    limit = min(100, int(raw_limit)) if raw_limit.isdecimal() and len(raw_limit) <= 4 else 20
+    cached = _entries_cache.get(limit)
+    if cached and cached[0] > time.monotonic():
+        g._entries_body_key = cached[2]
+        return app.response_class(cached[1], mimetype='application/json')
+
+    version = _entries_version
     db = get_db()
-    
-    cur = db.execute('''
-        SELECT e.id, e.unique_id, e.content, e.tags, e.images, e.video, e.ts,
-               e.is_pinned,
-                             e.view_count,
-                             e.manipulated,
-          IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as upvotes,
-          IFNULL((SELECT SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as downvotes,
-          IFNULL((SELECT COUNT(*) FROM reports r WHERE r.entry_id=e.id),0) as reports
-        FROM entries e
-        WHERE e.archived=0 AND e.deleted=0
-        ORDER BY e.is_pinned DESC, e.id DESC
-        LIMIT ?
-    ''', (limit,))
-    
-    rows = cur.fetchall()
-    entries = []
-    for r in rows:
+    entries = fetch_dicts(db, SQL_LIST_ENTRIES, (limit,))
+    for entry in entries:
         # Parse images from comma-separated string
-        images = r['images'].split(',') if r['images'] else []
-        entry_obj = {
-            'id': r['id'],
-            'unique_id': r['unique_id'],
-            'content': r['content'],
-            'tags': r['tags'],
-            'images': images,
-            'video': r['video'],
-            'ts': r['ts'],
-            'is_pinned': r['is_pinned'],
-            'view_count': r['view_count'],
-            'manipulated': r['manipulated'],
-            'upvotes': r['upvotes'],
-            'downvotes': r['downvotes'],
-            'reports': r['reports']
-        }
-        entries.append(entry_obj)
-    return jsonify({'entries': entries})
+        images = entry['images']
+        entry['images'] = images.split(',') if images else []
+    body = orjson.dumps({'entries': entries})
+    body_key = g._entries_body_key = f'entries:{limit}:{next(_entries_renders)}'
+    with _entries_cache_lock:
+        # Skip storing if a write landed while this body was being built
+        if version == _entries_version:
+            if len(_entries_cache) >= ENTRIES_CACHE_MAXSIZE:
+                _entries_cache.clear()
+            _entries_cache[limit] = (time.monotonic() + ENTRIES_CACHE_TTL, body, body_key)
+    return app.response_class(body, mimetype='application/json')
 
 
 @app.route('/api/vote', methods=['POST'])
 def api_vote():
-    init_db()
     data = request.get_json(silent=True)
     if not data:
         return jsonify({'message':'Invalid JSON'}), 400
@@ -409,45 +1262,36 @@ def api_vote():
     if vote not in (1, -1):
         return jsonify({'message':'Invalid vote'}), 400
     db = get_db()
-    cur = db.execute('SELECT id, archived FROM entries WHERE id=?', (entry_id,))
+    id_type, ident = get_identifier()
+    cur = db.execute(SQL_ENTRY_FOR_VOTE, (ident, id_type, entry_id))
     row = cur.fetchone()
     if not row:
         return jsonify({'message':'Entry not found'}), 404
     if row['archived']:
         return jsonify({'message':'Entry archived'}), 410
-
-    id_type, ident = get_identifier()
-    ts = datetime.now(datetime.UTC).isoformat() + 'Z'
-    # check existing vote
-    cur = db.execute('SELECT id, vote FROM votes WHERE entry_id=? AND identifier=? AND identifier_type=?', (entry_id, ident, id_type))
-    existing = cur.fetchone()
-    if existing:
-        if existing['vote'] == vote:
+    if row['cur_vote'] == vote:
+        return jsonify({'message':'Already voted','vote':vote}), 200
+
+    ts = iso_now()
+    with write_transaction(db):
+        # The vote triggers keep the entry's counters in step
+        cur = db.execute(SQL_UPSERT_VOTE, (entry_id, ident, id_type, vote, ts))
+        if not cur.rowcount:
             return jsonify({'message':'Already voted','vote':vote}), 200
-        # update
-        db.execute('UPDATE votes SET vote=?, ts=? WHERE id=?', (vote, ts, existing['id']))
-    else:
-        db.execute('INSERT INTO votes (entry_id, identifier, identifier_type, vote, ts) VALUES (?,?,?,?,?)', (entry_id, ident, id_type, vote, ts))
-    db.commit()
-
-    # compute counts
-    cur = db.execute('SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) as upvotes, SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) as downvotes FROM votes WHERE entry_id=?', (entry_id,))
-    counts = cur.fetchone()
-    up = counts['upvotes'] or 0
-    down = counts['downvotes'] or 0
-    return jsonify({'message':'ok','upvotes':up,'downvotes':down})
+        counts = db.execute(SQL_ENTRY_VOTES, (entry_id,)).fetchone()
+    invalidate_entries_cache()
+    return jsonify({'message':'ok','upvotes':counts['upvotes'],'downvotes':counts['downvotes']})
 
 
 @app.route('/api/report', methods=['POST'])
 def api_report():
-    init_db()
     data = request.get_json(silent=True)
     if not data:
         return jsonify({'message':'Invalid JSON'}), 400
     entry_id = int(data.get('entry_id') or 0)
     reason = sanitize(data.get('reason',''))
     db = get_db()
-    cur = db.execute('SELECT id, content, tags, ts, archived FROM entries WHERE id=?', (entry_id,))
+    cur = db.execute(SQL_ENTRY_FOR_REPORT, (entry_id,))
     row = cur.fetchone()
     if not row:
         return jsonify({'message':'Entry not found'}), 404
@@ -455,52 +1299,21 @@ def api_report():
         return jsonify({'message':'Entry already archived'}), 200
 
     id_type, ident = get_identifier()
-    # prevent duplicate reports from same identifier
-    cur = db.execute('SELECT id FROM reports WHERE entry_id=? AND identifier=? AND identifier_type=?', (entry_id, ident, id_type))
-    if cur.fetchone():
-        return jsonify({'message':'Already reported'}), 200
-
-    ts = datetime.now(datetime.UTC).isoformat() + 'Z'
-    db.execute('INSERT INTO reports (entry_id, identifier, identifier_type, reason, ts) VALUES (?,?,?,?,?)', (entry_id, ident, id_type, reason, ts))
-    db.commit()
-
-    # compute counts
-    cur = db.execute('SELECT COUNT(*) as cnt FROM reports WHERE entry_id=?', (entry_id,))
-    reports_cnt = cur.fetchone()['cnt'] or 0
-    cur = db.execute('SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) as upvotes FROM votes WHERE entry_id=?', (entry_id,))
-    up = (cur.fetchone()['upvotes'] or 0)
-
-    # If more than 25% of the upvotes reported the post -> archive
-    archived = False
-    try:
-        if up > 0 and (reports_cnt / up) > 0.25:
-            # archive entry: mark archived and write to archive dir outside static folder
-            db.execute('UPDATE entries SET archived=1 WHERE id=?', (entry_id,))
-            db.commit()
-            archived = True
-            # write archive file outside static folder
-            parent = os.path.dirname(BASE_DIR)
-            archive_dir = os.path.join(parent, 'archive')
-            os.makedirs(archive_dir, exist_ok=True)
-            archive_path = os.path.join(archive_dir, f'entry-{entry_id}.json')
-            entry_obj = {'id': entry_id, 'content': row['content'], 'tags': row['tags'], 'ts': row['ts'], 'archived_at': datetime.now(datetime.UTC).isoformat() + 'Z', 'reports': reports_cnt, 'upvotes': up}
-            try:
-                import json
-                with open(archive_path, 'w', encoding='utf-8') as f:
-                    json.dump(entry_obj, f, ensure_ascii=False, indent=2)
-            except Exception:
-                pass
-            # write a log entry
-            log_dir = os.path.join(parent, 'archive_logs')
-            os.makedirs(log_dir, exist_ok=True)
-            try:
-                with open(os.path.join(log_dir, 'archive.log'), 'a', encoding='utf-8') as lf:
-                    lf.write(f"{datetime.now(datetime.UTC).isoformat()}Z ARCHIVE entry {entry_id} reports={reports_cnt} upvotes={up}\n")
-            except Exception:
-                pass
-
-    except Exception:
-        pass
+    ts = iso_now()
+    with write_transaction(db):
+        # prevent duplicate reports from same identifier
+        cur = db.execute(SQL_INSERT_REPORT, (entry_id, ident, id_type, reason, ts))
+        if not cur.rowcount:
+            return jsonify({'message':'Already reported'}), 200
+        counts = db.execute(SQL_REPORT_ENTRY, (entry_id,)).fetchall()[0]
+    invalidate_entries_cache()
+    reports_cnt = counts['reports_count']
+    up = counts['upvotes']
+    archived = bool(counts['archived'])
+
+    if archived:
+        entry_obj = {'id': entry_id, 'content': row['content'], 'tags': row['tags'], 'ts': row['ts'], 'archived_at': ts, 'reports': reports_cnt, 'upvotes': up}
+        _io_executor.submit(write_archive, entry_obj)
 
     return jsonify({'message':'ok','reports':reports_cnt,'archived':archived})
 
@@ -508,40 +1321,20 @@ def api_report():
 # Comments endpoints
 @app.route('/api/comments/<int:entry_id>', methods=['GET'])
 def api_get_comments(entry_id):
-    init_db()
     db = get_db()
     
     # Get entry
-    cur = db.execute('SELECT id FROM entries WHERE id=?', (entry_id,))
+    cur = db.execute(SQL_ENTRY_EXISTS, (entry_id,))
     if not cur.fetchone():
         return jsonify({'message':'Entry not found'}), 404
     
     # Get comments
-    cur = db.execute('''
-        SELECT c.id, c.content, c.ts,
-            IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM comment_votes cv WHERE cv.comment_id=c.id),0) as upvotes,
-            IFNULL((SELECT SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) FROM comment_votes cv WHERE cv.comment_id=c.id),0) as downvotes
-        FROM comments c
-        WHERE c.entry_id=?
-        ORDER BY c.id DESC
-        LIMIT 100
-    ''', (entry_id,))
-    rows = cur.fetchall()
-    comments = []
-    for r in rows:
-        comments.append({
-            'id': r['id'],
-            'content': r['content'],
-            'ts': r['ts'],
-            'upvotes': r['upvotes'],
-            'downvotes': r['downvotes']
-        })
+    comments = fetch_dicts(db, SQL_LIST_COMMENTS, (entry_id,))
     return jsonify({'comments': comments})
 
 
 @app.route('/api/comments', methods=['POST'])
 def api_post_comment():
-    init_db()
     data = request.get_json(silent=True)
     if not data:
         return jsonify({'message':'Invalid JSON'}), 400
@@ -555,7 +1348,7 @@ def api_post_comment():
         return jsonify({'message':'Comentario demasiado largo (máx 500 caracteres)'}), 400
 
     db = get_db()
-    cur = db.execute('SELECT id, archived, deleted FROM entries WHERE id=?', (entry_id,))
+    cur = db.execute(SQL_ENTRY_FOR_COMMENT, (entry_id,))
     entry = cur.fetchone()
     if not entry:
         return jsonify({'message':'Entry not found'}), 404
@@ -565,20 +1358,15 @@ def api_post_comment():
         return jsonify({'message':'Cannot comment on deleted entry'}), 410
 
     id_type, ident = get_identifier()
-    ts = datetime.now(datetime.UTC).isoformat() + 'Z'
+    ts = iso_now()
 
     # Insert comment (use default values for upvotes/downvotes/deleted)
-    cur = db.execute(
-        'INSERT INTO comments (entry_id, content, identifier, identifier_type, ts) VALUES (?,?,?,?,?)',
-        (entry_id, content, ident, id_type, ts)
-    )
-    db.commit()
+    cur = db.execute(SQL_INSERT_COMMENT, (entry_id, content, ident, id_type, ts))
     comment_id = cur.lastrowid
 
     return jsonify({'message':'ok','id': comment_id, 'content': content, 'ts': ts}), 201
 @app.route('/api/comment-vote', methods=['POST'])
 def api_comment_vote():
-    init_db()
     data = request.get_json(silent=True)
     if not data:
         return jsonify({'message':'Invalid JSON'}), 400
@@ -590,39 +1378,22 @@ def api_comment_vote():
         return jsonify({'message':'Invalid vote'}), 400
 
     db = get_db()
-    cur = db.execute('SELECT id FROM comments WHERE id=?', (comment_id,))
+    cur = db.execute(SQL_COMMENT_EXISTS, (comment_id,))
     if not cur.fetchone():
         return jsonify({'message':'Comment not found'}), 404
 
     id_type, ident = get_identifier()
-    ts = datetime.now(datetime.UTC).isoformat() + 'Z'
-
-    # Check existing vote
-    cur = db.execute(
-        'SELECT id, vote FROM comment_votes WHERE comment_id=? AND identifier=? AND identifier_type=?',
-        (comment_id, ident, id_type)
-    )
-    existing = cur.fetchone()
+    ts = iso_now()
 
-    if existing:
-        if existing['vote'] == vote:
+    with write_transaction(db):
+        # Cast or change the vote; the triggers update the comment's counters
+        cur = db.execute(SQL_UPSERT_COMMENT_VOTE, (comment_id, ident, id_type, vote, ts))
+        if not cur.rowcount:
             return jsonify({'message':'Already voted','vote':vote}), 200
-        db.execute('UPDATE comment_votes SET vote=?, ts=? WHERE id=?', (vote, ts, existing['id']))
-    else:
-        db.execute(
-            'INSERT INTO comment_votes (comment_id, identifier, identifier_type, vote, ts) VALUES (?,?,?,?,?)',
-            (comment_id, ident, id_type, vote, ts)
-        )
-    db.commit()
 
-    # Get vote counts
-    cur = db.execute('''
-        SELECT 
-            IFNULL(SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END),0) as upvotes,
-            IFNULL(SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END),0) as downvotes
-        FROM comment_votes WHERE comment_id=?
-    ''', (comment_id,))
-    counts = cur.fetchone()
+        # Get vote counts
+        cur = db.execute(SQL_COMMENT_VOTES, (comment_id,))
+        counts = cur.fetchone()
 
     return jsonify({
         'message':'ok',
@@ -633,7 +1404,6 @@ def api_comment_vote():
 
 @app.route('/api/comment-report', methods=['POST'])
 def api_comment_report():
-    init_db()
     data = request.get_json(silent=True)
     if not data:
         return jsonify({'message':'Invalid JSON'}), 400
@@ -643,49 +1413,45 @@ def api_comment_report():
     reason = sanitize(data.get('reason',''))
     
     db = get_db()
-    cur = db.execute('SELECT id, entry_id FROM comments WHERE id=?', (comment_id,))
+    cur = db.execute(SQL_COMMENT_FOR_REPORT, (comment_id,))
     comment = cur.fetchone()
     if not comment:
         return jsonify({'message':'Comment not found'}), 404
     
     id_type, ident = get_identifier()
-    
-    # Check if already reported
-    cur = db.execute(
-        'SELECT id FROM comment_reports WHERE comment_id=? AND identifier=? AND identifier_type=?',
-        (comment_id, ident, id_type)
-    )
-    if cur.fetchone():
-        return jsonify({'message':'Already reported'}), 200
-    
-    ts = datetime.now(datetime.UTC).isoformat() + 'Z'
-    db.execute(
-        'INSERT INTO comment_reports (comment_id, identifier, identifier_type, reason, ts) VALUES (?,?,?,?,?)',
-        (comment_id, ident, id_type, reason, ts)
-    )
-    db.commit()
-    
-    # Get report count and upvotes
-    cur = db.execute('SELECT COUNT(*) as cnt FROM comment_reports WHERE comment_id=?', (comment_id,))
-    reports_cnt = cur.fetchone()['cnt'] or 0
-    
-    cur = db.execute(
-        'SELECT IFNULL(SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END),0) as upvotes FROM comment_votes WHERE comment_id=?',
-        (comment_id,)
-    )
-    upvotes = cur.fetchone()['upvotes'] or 0
-    
-    # Delete if more than 10% of upvotes reported it
-    deleted = False
-    if upvotes > 0 and (reports_cnt / upvotes) > 0.1:
-        db.execute('DELETE FROM comments WHERE id=?', (comment_id,))
-        db.commit()
-        deleted = True
-    
+    ts = iso_now()
+    
+    with write_transaction(db):
+        # Insert unless already reported
+        cur = db.execute(SQL_INSERT_COMMENT_REPORT, (comment_id, ident, id_type, reason, ts))
+        if not cur.rowcount:
+            return jsonify({'message':'Already reported'}), 200
+        counts = db.execute(SQL_COUNT_COMMENT_REPORT, (comment_id,)).fetchall()[0]
+        reports_cnt = counts['reports_count']
+        deleted = bool(counts['over_threshold'])
+        if deleted:
+            db.execute(SQL_DELETE_COMMENT, (comment_id,))
+
     return jsonify({'message':'ok','reports':reports_cnt,'deleted':deleted})
 
 # Admin endpoints
-admin_tokens = {}  # Simple in-memory token store (use Redis in production)
+ADMIN_TOKEN_TTL = 24 * 3600  # 1 day
+ADMIN_TOKEN_MAX = 1024
+
+
+def _token_hash(token):
+    """Key of a bearer token in the admin_tokens table.
+
+    Tokens are stored in the database so every worker process accepts
+    them; only their SHA-256 is kept.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def sweep_admin_tokens():
+    """Forget expired admin tokens."""
+    get_db().execute(SQL_SWEEP_ADMIN_TOKENS, (time.time(),))
+
 
 @app.route('/api/admin/verify-passkey', methods=['POST'])
 def verify_passkey():
@@ -697,7 +1463,10 @@ def verify_passkey():
     
     # Generate a token
     token = secrets.token_urlsafe(32)
-    admin_tokens[token] = datetime.datetime.now().isoformat()
+    db = get_db()
+    with write_transaction(db):
+        db.execute(SQL_INSERT_ADMIN_TOKEN, (_token_hash(token), time.time() + ADMIN_TOKEN_TTL))
+        db.execute(SQL_CAP_ADMIN_TOKENS, (ADMIN_TOKEN_MAX,))
     
     return jsonify({'token': token})
 
@@ -707,7 +1476,7 @@ def verify_admin_token():
         return None
     
     token = auth[7:]
-    if token in admin_tokens:
+    if get_db().execute(SQL_ADMIN_TOKEN_VALID, (_token_hash(token), time.time())).fetchone():
         return token
     return None
 
@@ -716,73 +1485,26 @@ def admin_data():
     if not verify_admin_token():
         return jsonify({'message': 'Unauthorized'}), 401
     
-    init_db()
     db = get_db()
     
     # Stats
-    entries = db.execute('SELECT COUNT(*) as cnt FROM entries WHERE archived=0 AND deleted=0').fetchone()['cnt']
-    archived = db.execute('SELECT COUNT(*) as cnt FROM entries WHERE archived=1 AND deleted=0').fetchone()['cnt']
-    deleted_entries = db.execute('SELECT COUNT(*) as cnt FROM entries WHERE deleted=1').fetchone()['cnt']
-    comments = db.execute('SELECT COUNT(*) as cnt FROM comments WHERE deleted=0').fetchone()['cnt']
-    deleted_comments = db.execute('SELECT COUNT(*) as cnt FROM comments WHERE deleted=1').fetchone()['cnt']
+    entries, archived, deleted_entries = db.execute(SQL_ADMIN_ENTRY_STATS).fetchone()
+    comments, deleted_comments = db.execute(SQL_ADMIN_COMMENT_STATS).fetchone()
     
     # All entries (not deleted)
-    entries_list = db.execute('''
-        SELECT e.id, e.content,
-               e.is_pinned, e.view_count, e.manipulated,
-               IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as upvotes,
-               IFNULL((SELECT SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as downvotes,
-               (SELECT COUNT(*) FROM reports WHERE entry_id=e.id) as reports
-        FROM entries e
-        WHERE e.deleted=0
-        ORDER BY e.id DESC
-    ''').fetchall()
+    entries_list = fetch_dicts(db, SQL_ADMIN_ENTRIES, (0,))
     
     # Deleted entries (for recycle bin)
-    deleted_entries_list = db.execute('''
-        SELECT e.id, e.content,
-               e.is_pinned, e.view_count, e.manipulated,
-               IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as upvotes,
-               IFNULL((SELECT SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) FROM votes v WHERE v.entry_id=e.id),0) as downvotes,
-               (SELECT COUNT(*) FROM reports WHERE entry_id=e.id) as reports
-        FROM entries e
-        WHERE e.deleted=1
-        ORDER BY e.id DESC
-    ''').fetchall()
-    
-    # All comments - calculate votes from comment_votes table
-    comments_list = db.execute('''
-        SELECT c.id, c.entry_id, c.content,
-               IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM comment_votes cv WHERE cv.comment_id=c.id),0) as upvotes,
-               IFNULL((SELECT SUM(CASE WHEN vote=-1 THEN 1 ELSE 0 END) FROM comment_votes cv WHERE cv.comment_id=c.id),0) as downvotes,
-               (SELECT COUNT(*) FROM comment_reports WHERE comment_id=c.id) as reports
-        FROM comments c
-        WHERE c.deleted=0
-        ORDER BY c.id DESC
-    ''').fetchall()
-    
-    # Reports
-    entry_reports = db.execute('''
-        SELECT 'entry' as type, entry_id as target_id, 
-               (SELECT upvotes FROM entries WHERE id=entry_id) as upvotes,
-               (SELECT COUNT(*) FROM reports WHERE entry_id=entry_id) as report_count,
-               reason
-        FROM reports
-        GROUP BY entry_id
-        HAVING report_count > 2
-    ''').fetchall()
-    
-    comment_reports = db.execute('''
-        SELECT 'comment' as type, comment_id as target_id,
-               IFNULL((SELECT SUM(CASE WHEN vote=1 THEN 1 ELSE 0 END) FROM comment_votes WHERE comment_id=comment_id),0) as upvotes,
-               (SELECT COUNT(*) FROM comment_reports WHERE comment_id=comment_id) as report_count,
-               reason
-        FROM comment_reports
-        GROUP BY comment_id
-        HAVING report_count > 1
-    ''').fetchall()
-    
-    reports = list(entry_reports) + list(comment_reports)
+    deleted_entries_list = fetch_dicts(db, SQL_ADMIN_ENTRIES, (1,))
+    
+    # All comments, with their maintained vote/report counters
+    comments_list = fetch_dicts(db, SQL_ADMIN_COMMENTS)
+    
+    # Reports, counted per target in one grouped pass
+    entry_reports = fetch_dicts(db, SQL_ADMIN_ENTRY_REPORTS)
+    comment_reports = fetch_dicts(db, SQL_ADMIN_COMMENT_REPORTS)
+    
+    reports = entry_reports + comment_reports
     
     return jsonify({
         'stats': {
@@ -792,10 +1514,10 @@ def admin_data():
             'total_comments': comments,
             'deleted_comments': deleted_comments
         },
-        'entries': [dict(e) for e in entries_list],
-        'deleted_entries': [dict(e) for e in deleted_entries_list],
-        'comments': [dict(c) for c in comments_list],
-        'reports': [dict(r) for r in reports]
+        'entries': entries_list,
+        'deleted_entries': deleted_entries_list,
+        'comments': comments_list,
+        'reports': reports
     })
 
 @app.route('/api/admin/entries/<int:entry_id>', methods=['DELETE'])
@@ -805,9 +1527,10 @@ def delete_entry_admin(entry_id):
         return jsonify({'message': 'Unauthorized'}), 401
     
     db = get_db()
-    now = datetime.datetime.now(datetime.UTC).isoformat()
+    now = iso_now()
     db.execute('UPDATE entries SET deleted=1, deleted_at=? WHERE id=?', (now, entry_id))
-    db.commit()
+    invalidate_entries_cache()
+    _viewable_entries.discard(entry_id)
     
     return jsonify({'message': 'Entry moved to recycle bin'})
 
@@ -818,7 +1541,7 @@ def restore_entry_admin(entry_id):
     
     db = get_db()
     db.execute('UPDATE entries SET deleted=0 WHERE id=?', (entry_id,))
-    db.commit()
+    invalidate_entries_cache()
     
     return jsonify({'message': 'Entry restored'})
 
@@ -828,9 +1551,10 @@ def permanently_delete_entry(entry_id):
         return jsonify({'message': 'Unauthorized'}), 401
     
     db = get_db()
+    # Votes, reports and comments (with their votes and reports) cascade
     db.execute('DELETE FROM entries WHERE id=?', (entry_id,))
-    db.execute('DELETE FROM comments WHERE entry_id=?', (entry_id,))
-    db.commit()
+    invalidate_entries_cache()
+    _viewable_entries.discard(entry_id)
     
     return jsonify({'message': 'Entry permanently deleted'})
 
@@ -843,14 +1567,17 @@ def pin_entry(entry_id):
     
     db = get_db()
     
-    # Get current pinned status
-    row = db.execute('SELECT is_pinned FROM entries WHERE id=?', (entry_id,)).fetchone()
-    if not row:
+    # Toggle and read back the new status in one statement. fetchall() runs
+    # the UPDATE to completion so the autocommit happens right away.
+    rows = db.execute(
+        'UPDATE entries SET is_pinned = 1 - is_pinned WHERE id=? RETURNING is_pinned',
+        (entry_id,)
+    ).fetchall()
+    if not rows:
         return jsonify({'message': 'Entry not found'}), 404
+    invalidate_entries_cache()
     
-    new_status = 1 - row['is_pinned']  # Toggle
-    db.execute('UPDATE entries SET is_pinned=? WHERE id=?', (new_status, entry_id))
-    db.commit()
+    new_status = rows[0]['is_pinned']
     
     action = 'pinned' if new_status else 'unpinned'
     return jsonify({'message': f'Entry {action}', 'is_pinned': new_status})
@@ -868,31 +1595,24 @@ def adjust_entry_votes(entry_id):
     
     db = get_db()
     
-    # Get current votes
-    row = db.execute(
-        'SELECT upvotes, downvotes FROM entries WHERE id=?',
-        (entry_id,)
-    ).fetchone()
-    
-    if not row:
+    # Apply the change (votes cannot go below 0), mark as manipulated and
+    # store timestamp, reading back the new counters
+    now = iso_now()
+    rows = db.execute('''
+        UPDATE entries SET upvotes=MAX(0, upvotes+?), downvotes=MAX(0, downvotes+?),
+                           manipulated=1, manipulated_at=?
+        WHERE id=?
+        RETURNING upvotes, downvotes
+    ''', (upvote_change, downvote_change, now, entry_id)).fetchall()
+    
+    if not rows:
         return jsonify({'message': 'Entry not found'}), 404
-    
-    # Calculate new votes (cannot go below 0)
-    new_upvotes = max(0, row['upvotes'] + upvote_change)
-    new_downvotes = max(0, row['downvotes'] + downvote_change)
-    
-    # Mark as manipulated and store timestamp
-    now = datetime.datetime.now(datetime.UTC).isoformat()
-    db.execute(
-        'UPDATE entries SET upvotes=?, downvotes=?, manipulated=1, manipulated_at=? WHERE id=?',
-        (new_upvotes, new_downvotes, now, entry_id)
-    )
-    db.commit()
+    invalidate_entries_cache()
     
     return jsonify({
         'message': 'Votes adjusted',
-        'upvotes': new_upvotes,
-        'downvotes': new_downvotes
+        'upvotes': rows[0]['upvotes'],
+        'downvotes': rows[0]['downvotes']
     })
 
 
@@ -914,7 +1634,7 @@ def get_entry_browser_info(entry_id):
     browser_info = {}
     if row['browser_info']:
         try:
-            browser_info = json.loads(row['browser_info'])
+            browser_info = orjson.loads(row['browser_info'])
         except:
             pass
     
@@ -923,21 +1643,27 @@ def get_entry_browser_info(entry_id):
 
 @app.route('/api/entries/<int:entry_id>/view', methods=['POST'])
 def increment_entry_view(entry_id):
-    """Increment view_count for an entry. Public endpoint called when an entry is viewed."""
-    init_db()
-    db = get_db()
-    row = db.execute('SELECT id FROM entries WHERE id=? AND deleted=0', (entry_id,)).fetchone()
-    if not row:
-        return jsonify({'message':'Entry not found'}), 404
-    db.execute('UPDATE entries SET view_count = IFNULL(view_count,0) + 1 WHERE id=?', (entry_id,))
-    db.commit()
+    """Increment view_count for an entry. Public endpoint called when an entry is viewed.
+
+    The view is buffered and written by flush_view_counts().
+    """
+    if entry_id not in _viewable_entries:
+        db = get_db()
+        row = db.execute(SQL_ENTRY_VIEWABLE, (entry_id,)).fetchone()
+        if not row:
+            return jsonify({'message':'Entry not found'}), 404
+        _viewable_entries.add(entry_id)
+    with _view_lock:
+        _view_buffer[entry_id] += 1
     return jsonify({'message':'view incremented'})
 
 
+with app.app_context():
+    init_db()
+start_background_tasks()
+
+
 if __name__ == '__main__':
-    # Create DB file if missing
-    if not os.path.exists(DB_PATH):
-        open(DB_PATH, 'a').close()
     # If you have cert.pem and key.pem in the project root, Flask will use them
     cert = os.path.join(BASE_DIR, 'cert.pem')
     key = os.path.join(BASE_DIR, 'key.pem')
@@ -947,4 +1673,6 @@ if __name__ == '__main__':
         print('Using SSL cert and key for HTTPS')
     else:
         print('No cert/key found — starting without HTTPS')
-    app.run(host='0.0.0.0', port=5000, debug=True, ssl_context=ssl_context)
+    # The debugger and reloader are opt-in: FLASK_DEBUG=1 python server.py
+    debug = os.environ.get('FLASK_DEBUG') == '1'
+    app.run(host='0.0.0.0', port=5000, debug=debug, threaded=True, ssl_context=ssl_context)